@@ -1,31 +1,112 @@
-import argparse, os, re, pandas as pd, math, datetime as dt
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import argparse, os, re, csv, pandas as pd, numpy as np, math, datetime as dt
+from collections import namedtuple
+from functools import lru_cache
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+
+try:
+    import pyarrow as pa, pyarrow.csv as pa_csv
+except ImportError:  # optional: fall back to pandas' own chunked reader
+    pa = pa_csv = None
+
+CHUNK_ROWS = 50_000
+CSV_BLOCK_BYTES = 8 << 20
+JINJA_CACHE_DIR = ".jinja_cache"
+STOCK_LIMIT = 10**15  # per-column clamp so absurd on-hand values can't overflow int64
+
+ACRONYMS = frozenset({"CCI","FMJ","JHP","JSP","TMJ","HST","PSP","LR","WMR","ACP","NATO","HP","SP","HMR","V-MAX","Vmax"})
+COLUMN_ALIASES = {
+    "sku": ["sku","upc","barcode"],
+    "partno": ["partno","part_no","mpn"],
+    "title": ["description","title","name"],
+    "manufacturer": ["manufacturer","brand","mfg"],
+    "category": ["category","dept","department"],
+    "price": ["store_price","price","msrp"],
+    "onhand_new": ["onhand new","onhand_new","qty","quantity","stock","onhand"],
+    "onhand_used": ["onhand used","onhand_used"],
+}
+Cols = namedtuple("Cols", COLUMN_ALIASES)
+
+_WS_RE = re.compile(r"\s+")
+_WS2_RE = re.compile(r"\s{2,}")
+_PKG_RE = re.compile(r"\b\d{2,3}/\d{1,3}\b")
+_MM_RE = re.compile(r"\b(\d{2,3})\s*MM\b", re.I)
+_GR_RE = re.compile(r"\b(\d{2,3})\s*GR\b", re.I)
+_DESC_RE = re.compile(r"^desc\d+a?$")
+_TOKEN_RE = re.compile(r"(\s+|-|/)")
+
+# Byte classes for measurement tokens: D=digit, P=dot
+_CLS = bytearray(256)
+_CLS[ord("0"):ord("9") + 1] = b"D" * 10
+_CLS[ord(".")] = ord("P")
+_D, _P = ord("D"), ord("P")
+_UNITS = (b"gr", b"grain", b"in")
 
-ACRONYMS = {"CCI","FMJ","JHP","JSP","TMJ","HST","PSP","LR","WMR","ACP","NATO","HP","SP","HMR","V-MAX","Vmax"}
 REPLACEMENTS = [
-    (r"\s+", " "),              # collapse whitespace
-    (r"\s{2,}", " "),
+    (_WS_RE, " "),              # collapse whitespace
 ]
 
+def _measure_kind(t):
+    # "dot" for .308-style, "unit" for 9mm / 40gr / 6.5in, else None
+    # The dot form only looks at the prefix, so the rest may be any text (.308Win®)
+    if len(t) >= 2 and t[0] == "." and t[1].isdecimal():
+        return "dot"
+    # Units are a single pass over the ASCII bytes
+    if not t.isascii():
+        return None
+    b = t.lower().encode("ascii")
+    n = len(b)
+    i = 0
+    while i < n and _CLS[b[i]] == _D:
+        i += 1
+    if i == 0:
+        return None
+    if b[i:] == b"mm":  # only whole-number calibers take mm
+        return "unit"
+    if i < n and _CLS[b[i]] == _P:
+        j = i + 1
+        while j < n and _CLS[b[j]] == _D:
+            j += 1
+        if j > i + 1:
+            i = j
+    return "unit" if b[i:] in _UNITS else None
+
+@lru_cache(maxsize=4096)
+def fix_token(tok):
+    t = tok
+    if t.upper() in ACRONYMS: return t.upper()
+    kind = _measure_kind(t)
+    if kind == "dot": return t  # .308
+    if kind == "unit": return t.lower()  # 9mm, 40gr, 6.5in
+    return t.capitalize()
+
+@lru_cache(maxsize=8192)
 def smart_title(s):
     # Title-case but preserve acronyms and measurements like 9mm, .308, 6.5
-    def fix_token(tok):
-        t = tok
-        if t.upper() in ACRONYMS: return t.upper()
-        if re.match(r"^\d+mm$", t.lower()): return t.lower()
-        if re.match(r"^\.\d+", t): return t  # .308
-        if re.match(r"^\d+(\.\d+)?(gr|grain|in)$", t.lower()): return t.lower()
-        return t.capitalize()
-    toks = re.split(r"(\s+|-|/)", s)
-    return "".join(fix_token(t) if t.strip() and not re.match(r"(\s+|-|/)", t) else t for t in toks)
+    toks = _TOKEN_RE.split(s)
+    return "".join(fix_token(t) if t.strip() and not _TOKEN_RE.match(t) else t for t in toks)
 
+def _is_clean_title(s, manufacturer):
+    # True when none of the clean_title rewrites below would change s
+    return (
+        s and s.isprintable()
+        and _WS2_RE.search(s) is None
+        and _PKG_RE.search(s) is None
+        and _MM_RE.search(s) is None
+        and _GR_RE.search(s) is None
+        and sum(map(str.isupper, s)) <= sum(map(str.islower, s))
+        and (not manufacturer or not s.upper().startswith(str(manufacturer).upper()))
+    )
+
+@lru_cache(maxsize=4096)
 def clean_title(raw, manufacturer=None):
     if not isinstance(raw, str): raw = str(raw or "")
     s = raw.strip()
+    if _is_clean_title(s, manufacturer):
+        return s
     for pat, rep in REPLACEMENTS:
-        s = re.sub(pat, rep, s)
+        s = pat.sub(rep, s)
     # Remove packaging tails like 50/10, 20/10 etc
-    s = re.sub(r"\b\d{2,3}/\d{1,3}\b", "", s).strip()
+    s = _PKG_RE.sub("", s).strip()
     # Remove duplicate manufacturer prefix if present
     if manufacturer and s.upper().startswith(str(manufacturer).upper()):
         s = s[len(manufacturer):].strip(" -")
@@ -33,59 +114,50 @@ def clean_title(raw, manufacturer=None):
     if s.isupper() or sum(1 for c in s if c.isupper()) > sum(1 for c in s if c.islower()):
         s = smart_title(s.lower())
     # Normalize calibers
-    s = re.sub(r"\b(\d{2,3})\s*MM\b", r"\1mm", s, flags=re.I)
-    s = re.sub(r"\b(\d{2,3})\s*GR\b", r"\1gr", s, flags=re.I)
+    s = _MM_RE.sub(r"\1mm", s)
+    s = _GR_RE.sub(r"\1gr", s)
     # Final trim
-    s = re.sub(r"\s{2,}", " ", s).strip()
+    s = _WS2_RE.sub(" ", s).strip()
     return s if s else "Untitled"
 
+@lru_cache(maxsize=8192)
 def clean_feature(s):
     if not isinstance(s, str): s = str(s or "")
     s = s.strip()
-    s = re.sub(r"\s{2,}", " ", s)
+    s = _WS2_RE.sub(" ", s)
     # Simple title-case while preserving acronyms
     return smart_title(s)
 
-def detect_columns(df: pd.DataFrame):
-    lower = {c.lower().strip(): c for c in df.columns}
-    alias = {
-        "sku": ["sku","upc","barcode"],
-        "partno": ["partno","part_no","mpn"],
-        "title": ["description","title","name"],
-        "manufacturer": ["manufacturer","brand","mfg"],
-        "category": ["category","dept","department"],
-        "price": ["store_price","price","msrp"],
-        "onhand_new": ["onhand new","onhand_new","qty","quantity","stock","onhand"],
-        "onhand_used": ["onhand used","onhand_used"],
-    }
+@lru_cache(maxsize=8)
+def detect_columns(columns):
+    # columns: tuple of CSV header names. Cached so every caller with the same header shares one lookup
+    lower = {c.lower().strip(): c for c in columns}
     def find_col(key):
         k = key.lower().strip()
         return lower.get(k)
-    col = {k: None for k in alias}
-    for key, options in alias.items():
+    col = {k: None for k in COLUMN_ALIASES}
+    for key, options in COLUMN_ALIASES.items():
         for opt in options:
             c = find_col(opt)
             if c:
                 col[key] = c
                 break
-    return col
-
-def row_instock(row, col):
-    v = 0
-    if col["onhand_new"] and pd.notna(row[col["onhand_new"]]):
-        try: v += int(float(row[col["onhand_new"]]))
-        except: pass
-    if col["onhand_used"] and pd.notna(row[col["onhand_used"]]):
-        try: v += int(float(row[col["onhand_used"]]))
-        except: pass
-    return v
+    return Cols(**col)
 
-def as_price(v):
-    try:
-        x = float(v)
-        return f"${x:,.2f}"
-    except Exception:
-        return None
+@lru_cache(maxsize=8)
+def detect_desc_columns(columns):
+    # desc1..descN / desc1a..descNa feature columns, in header order
+    return tuple(c for c in columns if _DESC_RE.match(c.lower().strip()))
+
+def stock_series(df, col):
+    # Sum of on-hand columns; unparseable, missing or non-finite counts as 0
+    v = pd.Series(0, index=df.index, dtype=np.int64)
+    for c in (col.onhand_new, col.onhand_used):
+        if c:
+            x = pd.to_numeric(df[c], errors="coerce").astype(np.float64)
+            x = x.where(np.isfinite(x), 0).clip(-STOCK_LIMIT, STOCK_LIMIT)
+            v += x.astype(np.int64)
+    return v
 
 def parse_args():
     ap = argparse.ArgumentParser(description="Build Squarespace-ready catalog HTML from CSV")
@@ -99,96 +171,182 @@ def parse_args():
     ap.add_argument("--no_clean_names", action="store_true", help="Disable product name cleanup")
     return ap.parse_args()
 
-def main():
-    args = parse_args()
-    df = pd.read_csv(args.csv)
-    col = detect_columns(df)
+def dedup_header(names):
+    # Name columns the way pandas.read_csv does: blanks become "Unnamed: i", repeats get .1, .2, ...
+    counts = {}
+    out = []
+    for i, name in enumerate(names):
+        name = name or f"Unnamed: {i}"
+        cur = counts.get(name, 0)
+        while cur > 0:
+            counts[name] = cur + 1
+            name = f"{name}.{cur}"
+            cur = counts.get(name, 0)
+        out.append(name)
+        counts[name] = cur + 1
+    return out
+
+def read_arrow_chunks(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        names = dedup_header(next(csv.reader(f), []))
+    read = pa_csv.ReadOptions(column_names=names, skip_rows=1, block_size=CSV_BLOCK_BYTES)
+    parse = pa_csv.ParseOptions(newlines_in_values=True)
+    convert = pa_csv.ConvertOptions(column_types={c: pa.string() for c in names}, strings_can_be_null=True)
+    with pa_csv.open_csv(path, read_options=read, parse_options=parse, convert_options=convert) as reader:
+        batch = None
+        for batch in reader:
+            yield batch.to_pandas()
+        if batch is None:  # header-only file: still report the columns
+            yield reader.schema.empty_table().to_pandas()
+
+def read_chunks(path):
+    # Yield the CSV as DataFrames of str/None cells, one block at a time
+    done = 0
+    if pa_csv is not None:
+        try:
+            for chunk in read_arrow_chunks(path):
+                done += len(chunk)
+                yield chunk
+            return
+        except pa.ArrowInvalid:
+            pass  # rows pyarrow rejects (e.g. short rows) are fine for pandas; resume after what was yielded
+    with pd.read_csv(path, chunksize=CHUNK_ROWS, dtype=str) as reader:
+        for chunk in reader:
+            if done and done >= len(chunk):
+                done -= len(chunk)
+                continue
+            yield chunk.iloc[done:]
+            done = 0
 
-    # Detect desc columns
-    desc_cols = []
-    for c in df.columns:
-        lc = c.lower().strip()
-        if re.match(r"^desc\d+a?$", lc):
-            desc_cols.append(c)
+def first_features_mask(cleaned):
+    # True for the first non-empty occurrence of each feature within its row, compared case-insensitively
+    n, d = cleaned.shape
+    if not cleaned.size:
+        return np.zeros((n, d), dtype=bool)
+    flat = cleaned.ravel()
+    codes, uniques = pd.factorize(flat)
+    lower_codes, _ = pd.factorize(pd.Index(uniques).str.lower())
+    codes = lower_codes[codes].astype(np.int64)
+    # Row-major order means np.unique's first index is the leftmost cell in each row
+    _, first = np.unique(np.repeat(np.arange(n, dtype=np.int64), d) * (codes.max() + 1) + codes, return_index=True)
+    keep = np.zeros(n * d, dtype=bool)
+    keep[first] = True
+    keep &= flat != ""
+    return keep.reshape(n, d)
 
+def build_rows(df, col, desc_cols, args, limit=None):
+    # Filter one chunk of the CSV and turn it into product rows (one column per field)
     # Apply base filters (category + stock)
-    if args.category and col["category"]:
-        df = df[df[col["category"]].astype(str).str.strip().str.lower() == args.category.strip().lower()]
+    if args.category and col.category:
+        df = df[df[col.category].str.strip().str.lower() == args.category.strip().lower()]
 
-    df["_stock"] = df.apply(lambda r: row_instock(r, col), axis=1)
+    df = df.assign(_stock=stock_series(df, col))
     if not args.show_oos:
         df = df[df["_stock"] >= args.min_stock]
 
-    if args.max:
-        df = df.head(args.max)
-
-    products = []
-    for _, r in df.iterrows():
-        raw_title = (str(r[col["title"]]) if col["title"] else "") if col["title"] in r else ""
-        manufacturer = str(r[col["manufacturer"]]) if col["manufacturer"] and pd.notna(r[col["manufacturer"]]) else ""
-        title = clean_title(raw_title, manufacturer) if not args.no_clean_names else (raw_title or "Untitled")
-        sku = str(r[col["sku"]]) if col["sku"] and pd.notna(r[col["sku"]]) else ""
-        category = str(r[col["category"]]) if col["category"] and pd.notna(r[col["category"]]) else ""
-        partno = str(r[col["partno"]]) if col["partno"] and pd.notna(r[col["partno"]]) else ""
-        price_str = as_price(r[col["price"]]) if col["price"] and pd.notna(r[col["price"]]) else ""
-        stock = int(r["_stock"]) if "_stock" in r else 0
-        in_stock = stock >= args.min_stock
-        stock_note = f"In stock: {stock}" if stock > 0 else "Out of stock"
-
-        # Collect features from desc* columns
-        feats = []
-        for dc in desc_cols:
-            val = r.get(dc, None)
-            if pd.notna(val) and str(val).strip():
-                feats.append(clean_feature(str(val).strip()))
-        # Dedup preserve order
-        seen = set(); features = []
-        for f in feats:
-            key = f.lower()
-            if key not in seen:
-                seen.add(key); features.append(f)
+    if limit:
+        df = df.head(limit)
+
+    # Pull the text columns once; cells are already str (read_chunks), so missing columns/values just become ""
+    text_keys = ["sku", "title", "manufacturer", "category", "partno"]
+    sub = pd.DataFrame(
+        {k: df[getattr(col, k)] if getattr(col, k) else pd.Series(None, index=df.index, dtype=object) for k in text_keys}
+    ).fillna("")
+
+    if args.no_clean_names:
+        sub["title"] = sub["title"].replace("", "Untitled")
+    else:
+        sub["title"] = [clean_title(t, m) for t, m in zip(sub["title"], sub["manufacturer"])]
+
+    price = pd.to_numeric(df[col.price], errors="coerce") if col.price else pd.Series(np.nan, index=df.index)
+    sub["price_str"] = price.map("${:,.2f}".format, na_action="ignore").fillna("")
+
+    stock = df["_stock"].to_numpy()
+    sub["in_stock"] = stock >= args.min_stock
+    sub["stock_note"] = np.where(stock > 0, "In stock: " + df["_stock"].astype(str), "Out of stock")
+
+    # Clean every desc* cell up front, then dedup the whole block at once
+    desc_arr = df[desc_cols].fillna("").apply(lambda c: c.str.strip()).to_numpy(dtype=object)
+    cleaned = np.vectorize(clean_feature, otypes=[object])(desc_arr)
+    keep = first_features_mask(cleaned)
+
+    # Keyword tail shared by every row: sku, partno, manufacturer, category (empties skipped)
+    kw_tail = sub["sku"]
+    for k in ("partno", "manufacturer", "category"):
+        kw_tail = kw_tail + np.where((kw_tail != "") & (sub[k] != ""), " ", "") + sub[k]
+
+    features_col, keywords_col = [], []
+    for row, mask, tail in zip(cleaned, keep, kw_tail):
+        features = row[mask].tolist()
 
         # Keywords for search
-        kws = " ".join(features + list(filter(None, [sku, partno, manufacturer, category])))
-
-        products.append({
-            "sku": sku,
-            "title": title,
-            "manufacturer": manufacturer or "",
-            "category": category or "",
-            "partno": partno or "",
-            "price_str": price_str or "",
-            "in_stock": in_stock,
-            "stock_note": stock_note,
-            "features": features[:8],
-            "keywords": kws
-        })
-
-    # Sort
-    products.sort(key=lambda p: (p["category"].lower(), p["title"].lower()))
-
-    cats = sorted({p["category"] for p in products if p["category"]})
-    mfgs = sorted({p["manufacturer"] for p in products if p["manufacturer"]})
+        kws = " ".join(filter(None, (" ".join(features), tail)))
+
+        features_col.append(features[:8])
+        keywords_col.append(kws)
+
+    sub["features"] = pd.Series(features_col, index=sub.index, dtype=object)
+    sub["keywords"] = pd.Series(keywords_col, index=sub.index, dtype=object)
+    return sub
 
+def main():
+    args = parse_args()
+
+    # Stream the CSV so only one chunk of raw rows is held at a time
+    col = desc_cols = None
+    parts = []
+    remaining = args.max
+    for chunk in read_chunks(args.csv):
+        if col is None:
+            col = detect_columns(tuple(chunk.columns))
+            desc_cols = list(detect_desc_columns(tuple(chunk.columns)))
+        if args.max and remaining <= 0:
+            break
+        sub = build_rows(chunk, col, desc_cols, args, limit=remaining)
+        parts.append(sub)
+        if args.max:
+            remaining -= len(sub)
+    sub = pd.concat(parts, ignore_index=True)
+
+    # Category/manufacturer repeat a lot; categoricals dedup them and make lowering cheap
+    for k in ("category", "manufacturer"):
+        sub[k] = sub[k].astype("category")
+
+    # Sort by category then title, case-insensitive; categories are lowered and ranked once, not per row
+    cat_rank, _ = pd.factorize(sub["category"].cat.categories.str.lower(), sort=True)
+    sub["_cl"] = cat_rank[sub["category"].cat.codes.to_numpy()]
+    sub["_tl"] = sub["title"].astype(str).str.lower()
+    sub.sort_values(["_cl", "_tl"], inplace=True, kind="mergesort")
+    sub.drop(columns=["_cl", "_tl"], inplace=True)
+
+    products = sub.to_dict(orient="records")
+    cats = sorted(sub["category"].cat.categories.drop("", errors="ignore").tolist())
+    mfgs = sorted(sub["manufacturer"].cat.categories.drop("", errors="ignore").tolist())
+
+    # Reuse compiled template bytecode across runs
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
     env = Environment(
         loader=FileSystemLoader("templates"),
         autoescape=select_autoescape(["html","xml"]),
-        trim_blocks=True, lstrip_blocks=True
+        trim_blocks=True, lstrip_blocks=True,
+        bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR)
     )
     tpl = env.get_template("catalog.html.j2")
-    html = tpl.render(
-        title=args.title,
-        total=len(products),
-        products=products,
-        categories=cats,
-        manufacturers=mfgs,
-        generated_at=dt.datetime.now().strftime("%b %d, %Y %I:%M %p"),
-        filtered_note=None if args.show_oos else f"showing items with stock ≥ {args.min_stock}"
-    )
-
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
-    with open(args.out, "w", encoding="utf-8") as f:
-        f.write(html)
+    # Stream straight to disk rather than building the whole page in memory; the temp file
+    # is swapped in only once rendering finished, so a failed build keeps the old page
+    tmp = args.out + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        tpl.stream(
+            title=args.title,
+            total=len(products),
+            products=products,
+            categories=cats,
+            manufacturers=mfgs,
+            generated_at=dt.datetime.now().strftime("%b %d, %Y %I:%M %p"),
+            filtered_note=None if args.show_oos else f"showing items with stock ≥ {args.min_stock}"
+        ).dump(f)
+    os.replace(tmp, args.out)
     print(f"Wrote {args.out} ({len(products)} products)")
 
 if __name__ == "__main__":
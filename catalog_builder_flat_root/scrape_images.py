@@ -1,6 +1,10 @@
-import argparse, os, re, time, io, sys, math, hashlib, mimetypes
+import argparse, os, re, time, io, sys, math, hashlib, json, mimetypes, threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 from duckduckgo_search import DDGS
 
@@ -16,9 +20,29 @@ ALLOW_DOMAINS = {
 }
 
 VALID_EXTS = {".jpg",".jpeg",".png",".webp",".gif"}
+DDG_HOST = "duckduckgo.com"
+DDG_CACHE_DIR = ".ddg_cache"  # kept out of out/, which is published as the site
+DDG_CACHE_TTL = 7 * 86400  # seconds before a cached query is asked again
+PER_HOST_CONCURRENCY = 2
+_UNSAFE_RE = re.compile(r"[^a-zA-Z0-9_.-]+")
+
+# One pooled session for every download so TCP/TLS connections get reused
+SESSION = requests.Session()
+SESSION.headers.update(DEFAULT_HEADERS)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.2))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Per-host slots so parallel workers stay polite to each site (and to DDG)
+_host_slots = defaultdict(lambda: threading.Semaphore(PER_HOST_CONCURRENCY))
+_host_slots_lock = threading.Lock()
+
+def host_slot(host):
+    with _host_slots_lock:
+        return _host_slots[host.lower()]
 
 def safe_filename(s):
-    return re.sub(r"[^a-zA-Z0-9_.-]+","_", s).strip("_")
+    return _UNSAFE_RE.sub("_", s).strip("_")
 
 def is_valid_image_url(u):
     try:
@@ -27,10 +51,9 @@ def is_valid_image_url(u):
     except Exception:
         return False
 
-def choose_candidates(query, max_results=12):
+def choose_candidates(ddg, query, max_results=12):
     # Prefer DDG images for simplicity and reliability in CI
-    with DDGS() as ddg:
-        results = ddg.images(keywords=query, max_results=max_results, safesearch="off")
+    results = ddg.images(keywords=query, max_results=max_results, safesearch="off")
     # Keep those from allowed domains first, then others
     allowed, other = [], []
     for r in results:
@@ -44,18 +67,45 @@ def choose_candidates(query, max_results=12):
             other.append(u)
     return allowed + other
 
+def cache_path(query):
+    return os.path.join(DDG_CACHE_DIR, hashlib.sha1(query.encode("utf-8")).hexdigest() + ".json")
+
+def cached_candidates(ddg, query, max_results=12, sleep=1.0):
+    # Candidate URLs for query, from the on-disk cache when a previous run already asked DDG
+    path = cache_path(query)
+    try:
+        if time.time() - os.path.getmtime(path) < DDG_CACHE_TTL:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    with host_slot(DDG_HOST):
+        candidates = choose_candidates(ddg, query, max_results=max_results)
+        time.sleep(sleep)
+    # Write then rename so parallel workers never read a half-written file
+    os.makedirs(DDG_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(candidates, f)
+    os.replace(tmp, path)
+    return candidates
+
 def download_image(url, timeout=15):
-    r = requests.get(url, headers=DEFAULT_HEADERS, timeout=timeout, stream=True)
+    r = SESSION.get(url, timeout=timeout, stream=True)
     r.raise_for_status()
     content = r.content
     return content
 
 def normalize_to_jpg(raw_bytes, max_px=1200, quality=88):
-    im = Image.open(io.BytesIO(raw_bytes)).convert("RGB")
+    im = Image.open(io.BytesIO(raw_bytes))
+    # Let libjpeg downscale during decode (no-op for other formats)
+    im.draft("RGB", (max_px, max_px))
+    im.load()
+    im = im.convert("RGB")
     w,h = im.size
     if max(w,h) > max_px:
         scale = max_px / float(max(w,h))
-        im = im.resize((int(w*scale), int(h*scale)))
+        im = im.resize((int(w*scale), int(h*scale)), Image.Resampling.BILINEAR)
     buf = io.BytesIO()
     im.save(buf, format="JPEG", quality=quality, optimize=True)
     return buf.getvalue()
@@ -67,55 +117,80 @@ def default_query(title, manufacturer, sku):
     if sku: parts.append(str(sku))
     return " ".join(parts)
 
+# One DDGS client per worker thread. duckduckgo_search poisons a client after its first
+# failed request (e.g. a rate limit), so a failing worker drops its client and starts fresh
+_ddg_local = threading.local()
+
+def worker_ddg():
+    if getattr(_ddg_local, "ddg", None) is None:
+        _ddg_local.ddg = DDGS()
+    return _ddg_local.ddg
+
+def fetch_one(task, sleep=1.0):
+    # Find, download and save one image; True if something was written to dest
+    _, query, dest = task
+    try:
+        candidates = cached_candidates(worker_ddg(), query, max_results=14, sleep=sleep)
+    except Exception:
+        _ddg_local.ddg = None
+        return False
+    for u in candidates:
+        try:
+            with host_slot(urlparse(u).netloc):
+                raw = download_image(u)
+                time.sleep(sleep)
+            jpg = normalize_to_jpg(raw)
+            with open(dest, "wb") as f:
+                f.write(jpg)
+            return True
+        except Exception:
+            continue
+    return False
+
 def main():
     ap = argparse.ArgumentParser(description="Fetch product images by query and save as out/assets/<SKU>.jpg")
     ap.add_argument("--csv", default="data/inventory.csv", help="Path to CSV processed by build.py mappings")
     ap.add_argument("--outdir", default="out/assets", help="Where to save images")
     ap.add_argument("--limit", type=int, default=150, help="Max products to attempt per run")
     ap.add_argument("--overwrite", action="store_true", help="Redownload existing images")
-    ap.add_argument("--sleep", type=float, default=1.0, help="Delay between downloads to be polite")
+    ap.add_argument("--sleep", type=float, default=1.0, help="Per-host delay between requests to be polite")
+    ap.add_argument("--workers", type=int, default=16, help="Number of parallel fetch workers")
     args = ap.parse_args()
 
     import pandas as pd
     from build import detect_columns, clean_title
     
     os.makedirs(args.outdir, exist_ok=True)
-    df = pd.read_csv(args.csv)
-    col = detect_columns(df)
+    df = pd.read_csv(args.csv, dtype=str)
+    col = detect_columns(tuple(df.columns))
 
-    attempted = 0
-    saved = 0
-    for _, r in df.iterrows():
-        if args.limit and attempted >= args.limit:
+    def text(key):
+        c = getattr(col, key)
+        return df[c].fillna("") if c else pd.Series("", index=df.index)
+
+    skus = text("sku")
+    keep = skus != ""
+    # One directory listing instead of a stat per SKU; queued names are added so duplicates run once
+    existing = set() if args.overwrite else {e.name for e in os.scandir(args.outdir)}
+    tasks = []
+    for sku, title_raw, manufacturer in zip(skus[keep], text("title")[keep], text("manufacturer")[keep]):
+        if args.limit and len(tasks) >= args.limit:
             break
-        sku = str(r[col["sku"]]) if col["sku"] and pd.notna(r[col["sku"]]) else None
-        if not sku: 
-            continue
-        dest = os.path.join(args.outdir, f"{sku}.jpg")
-        if os.path.exists(dest) and not args.overwrite:
+        name = f"{sku}.jpg"
+        if name in existing:
             continue
+        existing.add(name)
+        dest = os.path.join(args.outdir, name)
 
-        title_raw = str(r[col["title"]]) if col["title"] else ""
-        manufacturer = str(r[col["manufacturer"]]) if col["manufacturer"] else ""
         title = clean_title(title_raw, manufacturer=manufacturer)
-        query = default_query(title, manufacturer, sku)
+        tasks.append((sku, default_query(title, manufacturer, sku), dest))
 
-        attempted += 1
-        candidates = choose_candidates(query, max_results=14)
-        ok = False
-        for u in candidates:
-            try:
-                raw = download_image(u)
-                jpg = normalize_to_jpg(raw)
-                with open(dest, "wb") as f:
-                    f.write(jpg)
+    saved = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        for fut in as_completed([ex.submit(fetch_one, t, args.sleep) for t in tasks]):
+            if fut.result():
                 saved += 1
-                ok = True
-                break
-            except Exception as e:
-                continue
-        time.sleep(args.sleep)
-    print(f"Attempted: {attempted}, saved: {saved}, outdir: {args.outdir}")
+    print(f"Attempted: {len(tasks)}, saved: {saved}, outdir: {args.outdir}")
 
 if __name__ == "__main__":
     main()